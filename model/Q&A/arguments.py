@@ -97,7 +97,7 @@ class DataTrainingArguments:
         },
     )
     use_faiss: bool = field(
-        default=False, metadata={"help": "Whether to build with faiss"}
+        default=True, metadata={"help": "Whether to build with faiss when not using Elasticsearch"}
     )
     elastic: bool = field(
         default=True, metadata={"help": "Whether to use Elasticsearch"}
@@ -1,17 +1,80 @@
+import hashlib
 import json
+import ijson
+import orjson
 import pprint
 import warnings
 import re
 import os
+import mmap
 import argparse
+import itertools
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import ExitStack
+from multiprocessing import Pool
 from tqdm import tqdm
 from elasticsearch import Elasticsearch
+from elasticsearch.helpers import parallel_bulk
+from elasticsearch.exceptions import ConnectionTimeout, SerializationError
+from elasticsearch.serializer import JSONSerializer
 
 warnings.filterwarnings('ignore')
 
-def es_setting(index_name="origin-meeting-wiki"):
-    es = Elasticsearch('http://localhost:9200', timeout=30, max_retries=10, retry_on_timeout=True)
-    print("Ping Elasticsearch :", es.ping())
+# preprocess()에서 남겨둘 문자: A-Za-z0-9가-힣.?!,()~‘’“”:%&《》〈〉'㈜·-+, 공백, 한자(一-龥)
+_ALLOWED_RANGES = [("A", "Z"), ("a", "z"), ("0", "9"), ("가", "힣"), ("一", "龥")]
+_ALLOWED_CHARS = frozenset(
+    [chr(c) for start, end in _ALLOWED_RANGES for c in range(ord(start), ord(end) + 1)]
+    + list(".?!,()~‘’“”:%&《》〈〉'㈜·-+")
+)
+
+class _CleanTable(dict):
+    """
+    str.translate용 table, 처음 보는 문자만 판단해서 저장
+    개행 문자와 #은 공백으로, 허용되지 않은 문자는 제거
+    """
+    def __missing__(self, c):
+        ch = chr(c)
+        value = c if ch in _ALLOWED_CHARS or ch.isspace() else None
+        self[c] = value
+        return value
+
+_CLEAN_TABLE = _CleanTable({ord("\n"): " ", ord("#"): " "})
+_WS_RE = re.compile(r"\s+")
+
+class ORJSONSerializer(JSONSerializer):
+    """
+    기본 json 대신 orjson으로 요청 body와 응답을 변환
+    orjson이 모르는 type(Decimal, UUID 등)은 JSONSerializer.default로 처리
+    기본 json처럼 str이 아닌 dict key와 numpy 배열도 변환
+    """
+    options = orjson.OPT_NON_STR_KEYS | orjson.OPT_SERIALIZE_NUMPY
+
+    def dumps(self, data):
+        if isinstance(data, str):
+            return data
+        try:
+            return orjson.dumps(data, default=self.default, option=self.options).decode("utf-8")
+        except (ValueError, TypeError) as e:
+            raise SerializationError(data, e)
+
+    def loads(self, s):
+        try:
+            return orjson.loads(s)
+        except (ValueError, TypeError) as e:
+            raise SerializationError(s, e)
+
+# url별로 client를 한 번만 만들어 connection pool을 재사용
+_ES_CACHE = {}
+
+def es_setting(index_name="origin-meeting-wiki", url="http://localhost:9200"):
+    es = _ES_CACHE.get(url)
+    if es is None:
+        es = Elasticsearch(
+            url, timeout=30, max_retries=10, retry_on_timeout=True, maxsize=25, http_compress=True,
+            serializer=ORJSONSerializer()
+        )
+        print("Ping Elasticsearch :", es.ping())
+        _ES_CACHE[url] = es
 
     return es, index_name
 
@@ -44,76 +107,220 @@ def initial_index(es, index_name, setting_path = "./setting.json"):
     create_index(es, index_name, setting_path)
 
 def preprocess(text):
-    text = re.sub(r"\n", " ", text)
-    text = re.sub(r"\\n", " ", text)
-    text = re.sub(r"#", " ", text)
-    text = re.sub(r"[^A-Za-z0-9가-힣.?!,()~‘’“”"":%&《》〈〉''㈜·\-\'+\s一-龥]", "", text)
-    text = re.sub(r"\s+", " ", text).strip()  # 두 개 이상의 연속된 공백을 하나로 치환
+    text = text.replace("\\n", " ").translate(_CLEAN_TABLE)
+    text = _WS_RE.sub(" ", text).strip()  # 두 개 이상의 연속된 공백을 하나로 치환
     
     return text
 
+def text_fingerprint(text):
+    return hashlib.blake2b(text.encode("utf-8"), digest_size=16).digest()
+
+def iter_unique_texts(texts):
+    """
+    순서를 유지하면서 중복 text 제거
+    text 전체 대신 16 byte hash만 저장해 중복을 확인
+    """
+    seen = set()
+    for text in texts:
+        h = text_fingerprint(text)
+        if h not in seen:
+            seen.add(h)
+            yield text
+
+def unique_texts(texts):
+    return list(iter_unique_texts(texts))
+
 def load_json(dataset_path):
-    with open(dataset_path, "r") as f:
-        wiki = json.load(f)
+    # 전체 dict를 메모리에 올리지 않고 문서 단위로 stream 하면서 바로 전처리
+    with open(dataset_path, "rb") as f:
+        corpus = [
+            {"document_text": preprocess(text)}
+            for text in iter_unique_texts(v["text"] for _, v in ijson.kvitems(f, ""))
+        ]
+    return corpus
+
+def get_shard_paths(dataset_path, n_shards=8):
+    """
+    (예) n_shards=8: total_meeting_collection.json -> total_meeting_collection_shard_0of8.json, ...
+    shard 수를 파일 이름에 넣어, 다른 n_shards로 만든 shard를 재사용하지 않도록 함
+    """
+    root, ext = os.path.splitext(dataset_path)
+    return [f"{root}_shard_{i}of{n_shards}{ext}" for i in range(n_shards)]
+
+def shard_json(dataset_path, n_shards=8, overwrite=False):
+    """
+    하나의 큰 json을 id의 hash 기준으로 n_shards개의 json으로 분할
+    원본보다 나중에 만들어진 shard가 모두 있으면 다시 나누지 않고 재사용
+    """
+    shard_paths = get_shard_paths(dataset_path, n_shards)
+    dataset_mtime = os.path.getmtime(dataset_path)
+    if not overwrite and all(
+        os.path.isfile(path) and os.path.getmtime(path) >= dataset_mtime for path in shard_paths
+    ):
+        print(f"Reuse {n_shards} shards of {dataset_path}")
+        return shard_paths
+
+    # 중간에 실패한 shard가 재사용되지 않도록 임시 파일에 쓴 뒤 마지막에 교체
+    tmp_paths = [path + ".tmp" for path in shard_paths]
+    with ExitStack() as stack:
+        shards = [stack.enter_context(open(path, "w", encoding="utf-8")) for path in tmp_paths]
+        n_written = [0] * n_shards
+        for shard in shards:
+            shard.write("{")
+
+        with open(dataset_path, "rb") as f:
+            for key, value in ijson.kvitems(f, "", use_float=True):
+                i = int.from_bytes(hashlib.blake2b(key.encode("utf-8"), digest_size=8).digest(), "little") % n_shards
+                if n_written[i]:
+                    shards[i].write(",")
+                shards[i].write(f"{json.dumps(key, ensure_ascii=False)}:{json.dumps(value, ensure_ascii=False)}")
+                n_written[i] += 1
+
+        for shard in shards:
+            shard.write("}")
+
+    for tmp_path, path in zip(tmp_paths, shard_paths):
+        os.replace(tmp_path, path)
+    print(f"Split {dataset_path} into {n_shards} shards: {n_written}")
+    return shard_paths
+
+def load_shard(shard_path):
+    """
+    shard 하나를 stream으로 읽어 shard 내 중복을 제거하고 전처리
+    shard 간 중복은 load_json_shards에서 fingerprint로 제거
+    """
+    seen = set()
+    docs = []
+    with open(shard_path, "rb") as f:
+        for _, v in ijson.kvitems(f, ""):
+            h = text_fingerprint(v["text"])
+            if h not in seen:
+                seen.add(h)
+                docs.append((h, preprocess(v["text"])))
+
+    return docs
+
+def load_json_shards(shard_paths, processes=None):
+    """
+    shard_json으로 나눈 shard들을 process별로 나누어 병렬로 로드
+    문서 순서는 shard 순서를 따름
+    """
+    with Pool(processes) as pool:
+        shard_docs = pool.map(load_shard, shard_paths)
+
+    seen = set()
+    corpus = []
+    for h, text in itertools.chain.from_iterable(shard_docs):
+        if h not in seen:
+            seen.add(h)
+            corpus.append({"document_text": text})
 
-    texts = list(dict.fromkeys([v["text"] for v in wiki.values()]))
-    texts = [preprocess(text) for text in texts]
-    corpus = [
-        {"document_text": texts[i]} for i in range(len(texts))
-    ]
     return corpus
 
+def read_txt(path):
+    """
+    f.read()로 한 번 더 복사하지 않고 mmap한 파일을 바로 decode
+    """
+    with open(path, "rb") as f:
+        if os.fstat(f.fileno()).st_size == 0:  # 빈 파일은 mmap 할 수 없음
+            return ""
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+            return preprocess(str(mm, "utf-8", "replace"))
+
 def load_txt(folder):
     """
     사용자가 추가한 폴더의 모든 txt파일 로드
     """
     # folder = "../data/new_data/"
     file_list = os.listdir(folder)
-    file_list_txt = [file for file in file_list if file.endswith(".txt")]
+    file_list_txt = sorted([file for file in file_list if file.endswith(".txt")])
+    paths = [os.path.join(folder, file) for file in file_list_txt]
+
+    with ThreadPoolExecutor() as executor:
+        texts = list(executor.map(read_txt, paths))
 
-    texts = []
-    for file in file_list_txt:
-        path = os.path.join(folder, file)
-        f = open(path, "r")
-        data = f.read()
-        f.close()
-        texts.append(data)
-
-    texts = [preprocess(text) for text in texts]
     corpus = [
         {"document_text": texts[i]} for i in range(len(texts))
     ]
     
     return corpus
 
-def insert_data(es, index_name, dataset_path, type="json", start_id=None):
+def bulk_insert(es, index_name, corpus, ids, thread_count=8, queue_size=8, chunk_size=1000, max_chunk_bytes=10*1024*1024, ingest_settings=False):
+    """
+    문서별 es.index 대신 parallel_bulk로 여러 thread에서 chunk 단위 삽입
+    ingest_settings=True이면 삽입하는 동안 refresh, replica, translog fsync를 꺼두고, 끝나면 기존 설정으로 복원
+    검색 중인 index에 추가하는 경우에는 사용하지 말고, 새로 만든 index에만 사용
+    """
+    def actions():
+        for doc_id, text in zip(ids, corpus):
+            yield {"_index": index_name, "_id": doc_id, "_source": text}
+
+    if ingest_settings:
+        settings = es.indices.get_settings(index=index_name)[index_name]["settings"]["index"]
+        restore_settings = {
+            "refresh_interval": settings.get("refresh_interval", "1s"),
+            "number_of_replicas": settings.get("number_of_replicas", 1),
+            "translog.durability": settings.get("translog", {}).get("durability", "request"),
+        }
+        es.indices.put_settings(
+            index=index_name,
+            body={"index": {"refresh_interval": "-1", "number_of_replicas": 0, "translog.durability": "async"}}
+        )
+
+    try:
+        results = parallel_bulk(
+            es, actions(), thread_count=thread_count, queue_size=queue_size,
+            chunk_size=chunk_size, max_chunk_bytes=max_chunk_bytes, raise_on_error=False
+        )
+        for ok, info in tqdm(results, total=len(corpus)):
+            if not ok:
+                print(f"Unable to load document {info['index']['_id']}.")
+    finally:
+        if ingest_settings:
+            es.indices.put_settings(index=index_name, body={"index": restore_settings})
+        es.indices.refresh(index=index_name)
+
+def force_merge(es, index_name, max_num_segments=1, request_timeout=3600):
+    """
+    삽입이 끝난 index의 segment를 합쳐 검색 속도 개선
+    forcemerge는 merge가 끝날 때까지 응답하지 않으므로, timeout을 길게 잡고 retry 하지 않는 client로 요청
+    timeout이 나도 merge는 Elasticsearch에서 계속 진행됨
+    """
+    merge_es = Elasticsearch(es.transport.hosts, max_retries=0, retry_on_timeout=False)
+    try:
+        merge_es.indices.forcemerge(
+            index=index_name, max_num_segments=max_num_segments, request_timeout=request_timeout
+        )
+        print(f"Force merged {index_name} into {max_num_segments} segment(s)")
+    except ConnectionTimeout:
+        print(f"Force merge of {index_name} is still running after {request_timeout}s")
+    finally:
+        merge_es.close()
+
+def insert_data(es, index_name, dataset_path, type="json", start_id=None, **bulk_kwargs):
     if type == "json":
         corpus = load_json(dataset_path)
     elif type == "txt":
         corpus = load_txt(dataset_path)
+    elif type == "shards":
+        corpus = load_json_shards(dataset_path)
 
-    for i, text in enumerate(tqdm(corpus)):
-        try:
-            if isinstance(start_id, int):
-                es.index(index=index_name, id=start_id+i, body=text)    
-            else:
-                es.index(index=index_name, id=i, body=text)
-        except:
-            print(f"Unable to load document {i}.")
+    if isinstance(start_id, int):
+        ids = [start_id+i for i in range(len(corpus))]
+    else:
+        ids = list(range(len(corpus)))
+    bulk_insert(es, index_name, corpus, ids, **bulk_kwargs)
 
     n_records = count_doc(es, index_name=index_name)
     print(f"Succesfully loaded {n_records} into {index_name}")
     print("@@@@@@@ 데이터 삽입 완료 @@@@@@@")
 
-def insert_data_st(es, index_name, corpus, titles, start_id=None):
-    for i, text in enumerate(tqdm(corpus)):
-        try:
-            if isinstance(start_id, int):
-                es.index(index=index_name, id=start_id+i, body=text)    
-            else:
-                es.index(index=index_name, id=titles[i], body=text)
-        except:
-            print(f"Unable to load document {i}.")
+def insert_data_st(es, index_name, corpus, titles, start_id=None, **bulk_kwargs):
+    if isinstance(start_id, int):
+        ids = [start_id+i for i in range(len(corpus))]
+    else:
+        ids = titles
+    bulk_insert(es, index_name, corpus, ids, **bulk_kwargs)
 
     n_records = count_doc(es, index_name=index_name)
     print(f"Succesfully loaded {n_records} into {index_name}")
@@ -123,7 +330,7 @@ def read_uploadedfile(files):
     titles = []
     for file in files:
         title = file.name.split(".")[0]
-        text = file.read().decode('utf-8')
+        text = file.read().decode('utf-8', errors='replace')
         texts.append(title + " " + preprocess(text))
         titles.append(title)
     
@@ -165,6 +372,27 @@ def es_search(es, index_name, question, topk):
     res = es.search(index=index_name, body=query, size=topk)
     return res
 
+def es_msearch(es, index_name, questions, topk):
+    """
+    여러 질문을 msearch 한 번의 요청으로 검색
+    """
+    body = []
+    for question in questions:
+        body.append({"index": index_name})
+        body.append({
+            "query": {
+                "bool": {
+                    "must": [
+                        {"match": {"document_text": question}}
+                    ]
+                }
+            },
+            "size": topk
+        })
+
+    res = es.msearch(body=body)
+    return res
+
 def search_all(es, index_name):
     query = {
         "query": {
@@ -182,11 +410,22 @@ def check_index(es, user_index):
 
     return flag, indices
 
-def user_setting(es, index_name, corpus, titles, type="first", setting_path = "./setting.json"):
+def user_setting(es, index_name, corpus, titles, type="first", setting_path = "./setting.json", merge=False, **bulk_kwargs):
+    """
+    merge (False): 첫 번째 사용하는 경우 삽입 후 force_merge 여부 (CLI의 --force_merge와 같은 기본값)
+    bulk_kwargs는 bulk_insert로 전달되는 삽입 설정
+        thread_count (8): parallel_bulk worker thread 수, 보통 cluster CPU 수 x node 수
+        queue_size (8): thread에 넘길 chunk를 쌓아두는 queue 크기
+        chunk_size (1000): 한 번의 요청에 담을 문서 수
+        max_chunk_bytes (10MB): 한 번의 요청에 담을 최대 byte 수
+    첫 번째 사용하는 경우에만 새로 만든 index이므로 ingest_settings=True로 삽입
+    """
     if type == "first":
         # 첫 번째 사용하는 경우
         initial_index(es, index_name, setting_path=setting_path)
-        insert_data_st(es, index_name, corpus, titles)
+        insert_data_st(es, index_name, corpus, titles, ingest_settings=True, **bulk_kwargs)
+        if merge:
+            force_merge(es, index_name)
         doc_num = count_doc(es, index_name=index_name)  # 기존에 존재하는 doc 개수가 출력됨
         print("첫 번째 사용하는 경우")
         print("doc 개수: ", doc_num)
@@ -194,7 +433,7 @@ def user_setting(es, index_name, corpus, titles, type="first", setting_path = ".
     elif type == "second":
         # 두 번째 사용하는 경우
         doc_num = count_doc(es, index_name)  # 또 여기서는 잘 작동함
-        insert_data_st(es, index_name, corpus, titles, start_id=doc_num)
+        insert_data_st(es, index_name, corpus, titles, start_id=doc_num, **bulk_kwargs)
         print("두 번째 사용하는 경우")
         print("doc 개수: ", doc_num)
 
@@ -205,7 +444,19 @@ def main(args):
     """
     es, index_name = es_setting(index_name=args.index_name)
     initial_index(es, index_name, args.setting_path)
-    insert_data(es, index_name, args.dataset_path, type="json")
+    if args.n_shards > 1:
+        shard_paths = shard_json(args.dataset_path, n_shards=args.n_shards, overwrite=args.reshard)
+        dataset_path, type = shard_paths, "shards"
+    else:
+        dataset_path, type = args.dataset_path, "json"
+    insert_data(
+        es, index_name, dataset_path, type=type,
+        thread_count=args.thread_count, queue_size=args.queue_size,
+        chunk_size=args.chunk_size, max_chunk_bytes=args.max_chunk_bytes,
+        ingest_settings=True
+    )
+    if args.force_merge:
+        force_merge(es, index_name)
 
     query = "오늘 3시 40분에 세희랑 밥 먹은 사람 누구야?"
     res = es_search(es, index_name, query, 10)
@@ -222,6 +473,13 @@ if __name__ == "__main__":
     parser.add_argument("--setting_path", default="./setting.json", type=str, help="생성할 index의 setting.json 경로를 설정해주세요")
     parser.add_argument("--dataset_path", default="../data/meeting_collection.json", type=str, help="삽입할 데이터의 경로를 설정해주세요")
     parser.add_argument("--index_name", default="origin-meeting-wiki", type=str, help="테스트할 index name을 설정해주세요")
+    parser.add_argument("--thread_count", default=8, type=int, help="bulk 삽입에 사용할 thread 수를 설정해주세요")
+    parser.add_argument("--queue_size", default=8, type=int, help="bulk 삽입 thread에 넘길 chunk queue 크기를 설정해주세요")
+    parser.add_argument("--chunk_size", default=1000, type=int, help="bulk 요청 한 번에 담을 문서 수를 설정해주세요")
+    parser.add_argument("--max_chunk_bytes", default=10*1024*1024, type=int, help="bulk 요청 한 번에 담을 최대 byte 수를 설정해주세요")
+    parser.add_argument("--force_merge", action="store_true", help="삽입 후 index를 하나의 segment로 force merge 합니다")
+    parser.add_argument("--n_shards", default=1, type=int, help="데이터를 나누어 병렬로 로드할 shard 수를 설정해주세요 (1보다 크면 문서 순서가 shard 순서를 따르므로, n_shards=1일 때와 ES _id가 달라집니다)")
+    parser.add_argument("--reshard", action="store_true", help="이미 만들어진 shard가 있어도 원본 데이터를 다시 나눕니다")
 
     args = parser.parse_args()
     main(args)
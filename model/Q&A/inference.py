@@ -356,7 +356,7 @@ def run_sparse_retrieval(
         retriever.get_sparse_embedding()
 
 
-    if data_args.use_faiss:
+    if not data_args.elastic and data_args.use_faiss:
         retriever.build_faiss(num_clusters=data_args.num_clusters)
         df = retriever.retrieve_faiss(
             datasets["validation"], topk=data_args.top_k_retrieval
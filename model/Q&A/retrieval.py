@@ -1,15 +1,24 @@
-import json
+import hashlib
+import ijson
 import os
 import pickle
 import sys
 import time
 from contextlib import contextmanager
+from functools import lru_cache
 from typing import List, NoReturn, Optional, Tuple, Union
 
+import faiss
+import joblib
 import numpy as np
 import pandas as pd
+import scipy.sparse as sp
 from datasets import Dataset, concatenate_datasets, load_from_disk
-from sklearn.feature_extraction.text import TfidfVectorizer
+from elasticsearch.exceptions import TransportError
+from joblib import Parallel, cpu_count, delayed
+from sklearn.decomposition import TruncatedSVD
+from sklearn.feature_extraction.text import HashingVectorizer, TfidfTransformer
+from sklearn.pipeline import make_pipeline
 from tqdm.auto import tqdm
 from elastic_setting import *
 
@@ -23,6 +32,52 @@ def timer(name):
     print(f"[{name}] done in {time.time() - t0:.3f} s")
 
 
+def identity(x):
+    # 이미 tokenize된 입력을 그대로 넘기기 위한 tokenizer (lambda는 pickle이 안 됩니다)
+    return x
+
+
+def topk_rows(scores: np.ndarray, k: int) -> Tuple[np.ndarray, np.ndarray]:
+    # 각 row에서 argpartition으로 top-k만 고른 뒤, k개만 점수 내림차순으로 정렬합니다.
+    indices = np.argpartition(scores, -k, axis=1)[:, -k:]
+    top_scores = np.take_along_axis(scores, indices, axis=1)
+    order = np.argsort(-top_scores, axis=1)
+    return (
+        np.take_along_axis(top_scores, order, axis=1),
+        np.take_along_axis(indices, order, axis=1),
+    )
+
+
+def drop_missing(D: np.ndarray, I: np.ndarray) -> Tuple[List, List]:
+    # faiss는 찾은 passage가 k개보다 적으면 id를 -1로 채우므로, 해당 결과는 제외합니다.
+    found = I != -1
+    return (
+        [scores[mask].tolist() for scores, mask in zip(D, found)],
+        [indices[mask].tolist() for indices, mask in zip(I, found)],
+    )
+
+
+def retrieval_dataframe(
+    cols: dict, doc_indices: List, retrieved_contexts: List
+) -> pd.DataFrame:
+    # Dataset을 row마다 꺼내지 않고, 한 번에 꺼낸 column들로 DataFrame을 만듭니다.
+    cqas = pd.DataFrame(
+        {
+            # Query와 해당 id를 반환합니다.
+            "question": cols["question"],
+            "id": cols["id"],
+            # Retrieve한 Passage의 id, context를 반환합니다.
+            "context_id": doc_indices,
+            "context": retrieved_contexts,
+        }
+    )
+    if "context" in cols and "answers" in cols:
+        # validation 데이터를 사용하면 ground_truth context와 answer도 반환합니다.
+        cqas["original_context"] = cols["context"]
+        cqas["answers"] = cols["answers"]
+    return cqas
+
+
 class SparseRetrieval:
     def __init__(
         self,
@@ -32,52 +87,155 @@ class SparseRetrieval:
     ) -> NoReturn:
 
         self.data_path = data_path
-        with open(
-            os.path.join(data_path, context_path), "r", encoding="utf-8"
-        ) as f:
-            wiki = json.load(f)
-
-        self.contexts = list(
-            dict.fromkeys([v["text"] for v in wiki.values()])
-        )  # set 은 매번 순서가 바뀌므로
+        with open(os.path.join(data_path, context_path), "rb") as f:
+            # 전체 wiki dict를 올리지 않고 문서 단위로 stream 합니다.
+            self.contexts = unique_texts(
+                v["text"] for _, v in ijson.kvitems(f, "")
+            )  # set 은 매번 순서가 바뀌므로
         print(f"Lengths of unique contexts : {len(self.contexts)}")
-        self.ids = list(range(len(self.contexts)))
+        self.ids = np.arange(len(self.contexts), dtype=np.int32)
+        # doc_indices로 한 번에 gather 할 수 있도록 object array로도 들고 있습니다.
+        self.contexts_arr = np.array(self.contexts, dtype=object)
 
         # Transform by vectorizer
-        self.tfidfv = TfidfVectorizer(
+        # vocab을 만들지 않는 HashingVectorizer + TfidfTransformer 조합을 사용합니다.
+        self.tokenize_fn = tokenize_fn
+        self.hashv = HashingVectorizer(
             tokenizer=tokenize_fn,
             ngram_range=(1, 2),
-            max_features=50000,
+            n_features=2 ** 18,
+            alternate_sign=False,
+            dtype=np.float32,
         )
+        self.tfidfv = make_pipeline(self.hashv, TfidfTransformer())
 
         self.p_embedding = None  # get_sparse_embedding()로 생성합니다
+        self.p_embedding_T = None  # get_sparse_embedding()로 생성합니다
+        self.cached_scores = None  # get_sparse_embedding()로 생성합니다
+        self.svd = None  # build_faiss()로 생성합니다.
         self.indexer = None  # build_faiss()로 생성합니다.
 
     def get_sparse_embedding(self) -> NoReturn:
 
-        # Pickle을 저장
-        pickle_name = f"sparse_embedding.bin"
-        tfidfv_name = f"tfidv.bin"
-        emd_path = os.path.join(self.data_path, pickle_name)
+        # embedding은 npz로, vectorizer는 joblib으로 저장
+        emd_name = f"sparse_embedding.npz"
+        tfidfv_name = f"tfidv.joblib"
+        emd_path = os.path.join(self.data_path, emd_name)
         tfidfv_path = os.path.join(self.data_path, tfidfv_name)
 
         if os.path.isfile(emd_path) and os.path.isfile(tfidfv_path):
-            with open(emd_path, "rb") as file:
-                self.p_embedding = pickle.load(file)
-            with open(tfidfv_path, "rb") as file:
-                self.tfidfv = pickle.load(file)
-            print("Embedding pickle load.")
+            self.p_embedding = sp.load_npz(emd_path)
+            self.tfidfv = joblib.load(tfidfv_path)
+            self.hashv = self.tfidfv[0]
+            print("Embedding load.")
         else:
             print("Build passage embedding")
-            self.p_embedding = self.tfidfv.fit_transform(self.contexts)
+            counts = self.get_hashed_counts()
+            self.p_embedding = self.tfidfv[-1].fit_transform(counts)
             print(self.p_embedding.shape)
-            with open(emd_path, "wb") as file:
-                pickle.dump(self.p_embedding, file)
-            with open(tfidfv_path, "wb") as file:
-                pickle.dump(self.tfidfv, file)
-            print("Embedding pickle saved.")
+            sp.save_npz(emd_path, self.p_embedding, compressed=False)
+            joblib.dump(self.tfidfv, tfidfv_path, compress=3)
+            print("Embedding saved.")
+
+        # float32/int32로 memory bandwidth를 줄이고, query마다 transpose하지 않도록 미리 CSR로 만들어둡니다.
+        self.p_embedding = self.p_embedding.astype(np.float32)
+        if self.p_embedding.nnz < np.iinfo(np.int32).max:
+            self.p_embedding.indices = self.p_embedding.indices.astype(np.int32)
+            self.p_embedding.indptr = self.p_embedding.indptr.astype(np.int32)
+        self.p_embedding_T = self.p_embedding.T.tocsr()
+        self.cached_scores = lru_cache(maxsize=1024)(self.get_query_scores)
+
+    def get_hashed_counts(self, n_jobs: Optional[int] = -1):
+
+        """
+        Note:
+            tokenize 결과를 tokens.bin으로 저장해두고, 다음 실행부터는 tokenize를 건너뜁니다.
+            contexts가 바뀌면 저장된 tokens와 row가 맞지 않으므로, fingerprint가 다르면 다시 tokenize 합니다.
+            hashing은 상태가 없으므로 contexts를 n_jobs개로 나누어 병렬로 처리한 뒤 합칩니다.
+        """
+
+        tokens_path = os.path.join(self.data_path, "tokens.bin")
+        fingerprint = self.get_contexts_fingerprint()
+        tokens = None
+        if os.path.isfile(tokens_path):
+            with open(tokens_path, "rb") as file:
+                cache = pickle.load(file)
+            if isinstance(cache, dict) and cache.get("fingerprint") == fingerprint:
+                tokens = cache["tokens"]
+                print("Tokens pickle load.")
+            else:
+                print("Tokens pickle is stale, tokenize again.")
+
+        if tokens is None:
+            # query는 HashingVectorizer가 lowercase 후 tokenize 하므로, context도 같은 순서로 처리합니다.
+            tokens = [
+                self.tokenize_fn(context.lower() if self.hashv.lowercase else context)
+                for context in tqdm(self.contexts, desc="Tokenize: ")
+            ]
+            with open(tokens_path, "wb") as file:
+                pickle.dump({"fingerprint": fingerprint, "tokens": tokens}, file)
+            print("Tokens pickle saved.")
+        assert len(tokens) == len(self.contexts), "tokens.bin과 contexts의 개수가 다릅니다."
+
+        params = self.hashv.get_params()
+        params.update(tokenizer=identity, preprocessor=identity)
+        token_hashv = HashingVectorizer(**params)
+        n_shards = cpu_count() if n_jobs == -1 else n_jobs
+        shard_size = max(1, -(-len(tokens) // n_shards))
+        shards = [tokens[i : i + shard_size] for i in range(0, len(tokens), shard_size)]
+        counts = Parallel(n_jobs=n_jobs)(delayed(token_hashv.transform)(shard) for shard in shards)
+        return sp.vstack(counts).tocsr()
+
+    def get_contexts_fingerprint(self) -> str:
+        # contexts 순서와 내용, lowercase 여부가 같으면 같은 값을 반환합니다.
+        h = hashlib.blake2b(digest_size=16)
+        h.update(str(self.hashv.lowercase).encode("utf-8"))
+        for context in self.contexts:
+            h.update(text_fingerprint(context))
+        return h.hexdigest()
+
+    def build_faiss(self, num_clusters=64, n_components=256, nprobe=16) -> NoReturn:
+
+        """
+        Note:
+            2**18 차원의 sparse embedding을 그대로 dense로 만들 수 없으므로,
+            TruncatedSVD로 n_components 차원까지 줄인 뒤 faiss index를 만듭니다.
+            TF-IDF의 내적과 같은 기준으로 비교하도록 inner product를 사용합니다.
+            검색할 때는 num_clusters 중 nprobe개의 cluster를 탐색합니다.
+        """
+
+        svd_name = f"svd{n_components}.bin"
+        indexer_name = f"faiss_clusters{num_clusters}_svd{n_components}_ip.index"
+        svd_path = os.path.join(self.data_path, svd_name)
+        indexer_path = os.path.join(self.data_path, indexer_name)
+
+        if os.path.isfile(svd_path) and os.path.isfile(indexer_path):
+            with open(svd_path, "rb") as file:
+                self.svd = pickle.load(file)
+            self.indexer = faiss.read_index(indexer_path)
+            print("Load Saved Faiss Indexer.")
+        else:
+            self.svd = TruncatedSVD(n_components=n_components)
+            p_emb = self.svd.fit_transform(self.p_embedding).astype(np.float32)
+            emb_dim = p_emb.shape[-1]
+
+            quantizer = faiss.IndexFlatIP(emb_dim)
+            self.indexer = faiss.IndexIVFScalarQuantizer(
+                quantizer,
+                quantizer.d,
+                num_clusters,
+                faiss.ScalarQuantizer.QT_8bit,
+                faiss.METRIC_INNER_PRODUCT,
+            )
+            self.indexer.train(p_emb)
+            self.indexer.add(p_emb)
+
+            with open(svd_path, "wb") as file:
+                pickle.dump(self.svd, file)
+            faiss.write_index(self.indexer, indexer_path)
+            print("Faiss Indexer Saved.")
 
-    def build_faiss(self, num_clusters=64) -> NoReturn:
+        self.indexer.nprobe = min(nprobe, num_clusters)
 
     def retrieve(
         self, query_or_dataset: Union[str, Dataset], topk: Optional[int] = 1
@@ -85,7 +243,7 @@ class SparseRetrieval:
 
         assert (
             self.p_embedding is not None
-        ), 
+        ), "get_sparse_embedding()을 먼저 수행해주세요."
 
         if isinstance(query_or_dataset, str):
             doc_scores, doc_indices = self.get_relevant_doc(
@@ -99,61 +257,54 @@ class SparseRetrieval:
 
             return (
                 doc_scores,
-                [self.contexts[doc_indices[i]] for i in range(topk)],
+                self.contexts_arr[doc_indices[:topk]].tolist(),
             )
 
         elif isinstance(query_or_dataset, Dataset):
 
             # Retrieve한 Passage를 pd.DataFrame으로 반환합니다.
-            total = []
+            cols = query_or_dataset[:]
             with timer("query exhaustive search"):
                 doc_scores, doc_indices = self.get_relevant_doc_bulk(
-                    query_or_dataset["question"], k=topk
+                    cols["question"], k=topk
                 )
-            for idx, example in enumerate(
-                tqdm(query_or_dataset, desc="Sparse retrieval: ")
-            ):
-                tmp = {
-                    # Query와 해당 id를 반환합니다.
-                    "question": example["question"],
-                    "id": example["id"],
-                    # Retrieve한 Passage의 id, context를 반환합니다.
-                    "context_id": doc_indices[idx],
-                    "context": " ".join(
-                        [self.contexts[pid] for pid in doc_indices[idx]]
-                    ),
-                }
-                if "context" in example.keys() and "answers" in example.keys():
-                    # validation 데이터를 사용하면 ground_truth context와 answer도 반환합니다.
-                    tmp["original_context"] = example["context"]
-                    tmp["answers"] = example["answers"]
-                total.append(tmp)
-
-            cqas = pd.DataFrame(total)
-            return cqas
+            retrieved_contexts = [
+                " ".join(self.contexts_arr[indices])
+                for indices in tqdm(doc_indices, desc="Sparse retrieval: ")
+            ]
+            return retrieval_dataframe(cols, doc_indices, retrieved_contexts)
 
     def get_relevant_doc(
         self, query: str, k: Optional[int] = 1
     ) -> Tuple[List, List]:
 
+        with timer("query ex search"):
+            result = self.cached_scores(query)
+
+        doc_score, doc_indices = topk_rows(result[None, :], min(k, result.shape[0]))
+        return doc_score[0].tolist(), doc_indices[0].tolist()
+
+    def get_query_scores(self, query: str) -> np.ndarray:
+
+        """
+        Note:
+            get_sparse_embedding()에서 instance마다 lru_cache로 감싼 cached_scores를 만들어,
+            같은 query가 다시 들어오면 tokenize, transform, 행렬곱을 건너뜁니다.
+            반환된 배열은 cache에 저장되므로 읽기 전용으로 반환합니다.
+        """
+
         with timer("transform"):
             query_vec = self.tfidfv.transform([query])
         assert (
-            np.sum(query_vec) != 0
+            query_vec.nnz > 0
         ), "오류가 발생했습니다. 이 오류는 보통 query에 vectorizer의 vocab에 없는 단어만 존재하는 경우 발생합니다."
 
-        with timer("query ex search"):
-            result = query_vec * self.p_embedding.T
-        if not isinstance(result, np.ndarray):
-            result = result.toarray()
-
-        sorted_result = np.argsort(result.squeeze())[::-1]
-        doc_score = result.squeeze()[sorted_result].tolist()[:k]
-        doc_indices = sorted_result.tolist()[:k]
-        return doc_score, doc_indices
+        scores = (query_vec * self.p_embedding_T).toarray().ravel()
+        scores.setflags(write=False)
+        return scores
 
     def get_relevant_doc_bulk(
-        self, queries: List, k: Optional[int] = 1
+        self, queries: List, k: Optional[int] = 1, chunk_size: Optional[int] = 64
     ) -> Tuple[List, List]:
 
         """
@@ -162,24 +313,31 @@ class SparseRetrieval:
                 하나의 Query를 받습니다.
             k (Optional[int]): 1
                 상위 몇 개의 Passage를 반환할지 정합니다.
+            chunk_size (Optional[int]): 64
+                한 번에 dense로 만들어 top-k를 구할 query 수를 정합니다.
         Note:
             vocab 에 없는 이상한 단어로 query 하는 경우 assertion 발생 (예) 뙣뙇?
         """
 
         query_vec = self.tfidfv.transform(queries)
         assert (
-            np.sum(query_vec) != 0
+            query_vec.nnz > 0
         ), "오류가 발생했습니다. 이 오류는 보통 query에 vectorizer의 vocab에 없는 단어만 존재하는 경우 발생합니다."
 
-        result = query_vec * self.p_embedding.T
-        if not isinstance(result, np.ndarray):
-            result = result.toarray()
+        result = query_vec * self.p_embedding_T
+        k = min(k, result.shape[1])
+
+        # 전체 Q x N 행렬을 dense로 만들지 않고, chunk_size개 row씩 나누어 thread로 top-k를 구합니다.
+        # numpy의 argpartition/argsort는 GIL을 풀기 때문에 thread로도 병렬 처리됩니다.
+        chunks = Parallel(n_jobs=-1, prefer="threads")(
+            delayed(topk_rows)(result[i : i + chunk_size].toarray(), k)
+            for i in range(0, result.shape[0], chunk_size)
+        )
         doc_scores = []
         doc_indices = []
-        for i in range(result.shape[0]):
-            sorted_result = np.argsort(result[i, :])[::-1]
-            doc_scores.append(result[i, :][sorted_result].tolist()[:k])
-            doc_indices.append(sorted_result.tolist()[:k])
+        for scores, indices in chunks:
+            doc_scores.extend(scores.tolist())
+            doc_indices.extend(indices.tolist())
         return doc_scores, doc_indices
 
     def retrieve_faiss(
@@ -195,45 +353,29 @@ class SparseRetrieval:
             )
             print("[Search query]\n", query_or_dataset, "\n")
 
-            for i in range(topk):
+            for i in range(len(doc_indices)):
                 print("Top-%d passage with score %.4f" % (i + 1, doc_scores[i]))
                 print(self.contexts[doc_indices[i]])
 
             return (
                 doc_scores,
-                [self.contexts[doc_indices[i]] for i in range(topk)],
+                self.contexts_arr[doc_indices].tolist(),
             )
 
         elif isinstance(query_or_dataset, Dataset):
 
             # Retrieve한 Passage를 pd.DataFrame으로 반환합니다.
-            queries = query_or_dataset["question"]
-            total = []
+            cols = query_or_dataset[:]
 
             with timer("query faiss search"):
                 doc_scores, doc_indices = self.get_relevant_doc_bulk_faiss(
-                    queries, k=topk
+                    cols["question"], k=topk
                 )
-            for idx, example in enumerate(
-                tqdm(query_or_dataset, desc="Sparse retrieval: ")
-            ):
-                tmp = {
-                    # Query와 해당 id를 반환합니다.
-                    "question": example["question"],
-                    "id": example["id"],
-                    # Retrieve한 Passage의 id, context를 반환합니다.
-                    "context_id": doc_indices[idx],
-                    "context": " ".join(
-                        [self.contexts[pid] for pid in doc_indices[idx]]
-                    ),
-                }
-                if "context" in example.keys() and "answers" in example.keys():
-                    # validation 데이터를 사용하면 ground_truth context와 answer도 반환합니다.
-                    tmp["original_context"] = example["context"]
-                    tmp["answers"] = example["answers"]
-                total.append(tmp)
-
-            return pd.DataFrame(total)
+            retrieved_contexts = [
+                " ".join(self.contexts_arr[indices])
+                for indices in tqdm(doc_indices, desc="Sparse retrieval: ")
+            ]
+            return retrieval_dataframe(cols, doc_indices, retrieved_contexts)
 
     def get_relevant_doc_faiss(
         self, query: str, k: Optional[int] = 1
@@ -242,14 +384,15 @@ class SparseRetrieval:
 
         query_vec = self.tfidfv.transform([query])
         assert (
-            np.sum(query_vec) != 0
+            query_vec.nnz > 0
         ), "오류가 발생했습니다. 이 오류는 보통 query에 vectorizer의 vocab에 없는 단어만 존재하는 경우 발생합니다."
 
-        q_emb = query_vec.toarray().astype(np.float32)
+        q_emb = self.svd.transform(query_vec).astype(np.float32)
         with timer("query faiss search"):
             D, I = self.indexer.search(q_emb, k)
 
-        return D.tolist()[0], I.tolist()[0]
+        doc_scores, doc_indices = drop_missing(D, I)
+        return doc_scores[0], doc_indices[0]
 
     def get_relevant_doc_bulk_faiss(
         self, queries: List, k: Optional[int] = 1
@@ -257,13 +400,13 @@ class SparseRetrieval:
 
         query_vecs = self.tfidfv.transform(queries)
         assert (
-            np.sum(query_vecs) != 0
+            query_vecs.nnz > 0
         ), "오류가 발생했습니다. 이 오류는 보통 query에 vectorizer의 vocab에 없는 단어만 존재하는 경우 발생합니다."
 
-        q_embs = query_vecs.toarray().astype(np.float32)
+        q_embs = self.svd.transform(query_vecs).astype(np.float32)
         D, I = self.indexer.search(q_embs, k)
 
-        return D.tolist(), I.tolist()
+        return drop_missing(D, I)
 
 class ElasticRetrieval:
     def __init__(self, INDEX_NAME):
@@ -285,34 +428,17 @@ class ElasticRetrieval:
 
         elif isinstance(query_or_dataset, Dataset):
             # Retrieve한 Passage를 pd.DataFrame으로 반환합니다.
-            total = []
+            cols = query_or_dataset[:]
             with timer("query exhaustive search"):
                 doc_scores, doc_indices, docs = self.get_relevant_doc_bulk(
-                    query_or_dataset["question"], k=topk
+                    cols["question"], k=topk
                 )
 
-            for idx, example in enumerate(tqdm(query_or_dataset, desc="Sparse retrieval with Elasticsearch: ")):
-                # retrieved_context 구하는 부분 수정
-                retrieved_context = []
-                for i in range(min(topk, len(docs[idx]))):
-                    retrieved_context.append(docs[idx][i]['_source']['document_text'])
-
-                tmp = {
-                    # Query와 해당 id를 반환합니다.
-                    "question": example["question"],
-                    "id": example["id"],
-                    # Retrieve한 Passage의 id, context를 반환합니다.
-                    "context_id": doc_indices[idx],
-                    "context": " ".join(retrieved_context),  # 수정
-                }
-                if "context" in example.keys() and "answers" in example.keys():
-                    # validation 데이터를 사용하면 ground_truth context와 answer도 반환합니다.
-                    tmp["original_context"] = example["context"]
-                    tmp["answers"] = example["answers"]
-                total.append(tmp)
-
-            cqas = pd.DataFrame(total)
-            return cqas
+            retrieved_contexts = [
+                " ".join([doc['_source']['document_text'] for doc in hits[:topk]])
+                for hits in tqdm(docs, desc="Sparse retrieval with Elasticsearch: ")
+            ]
+            return retrieval_dataframe(cols, doc_indices, retrieved_contexts)
     
     def retrieve_split(self, query_or_dataset: Union[str, Dataset], topk: Optional[int] = 1):
         with timer("query exhaustive search"):
@@ -329,9 +455,9 @@ class ElasticRetrieval:
                 tmp = {
                     # Query와 해당 id를 반환합니다.
                     "question": example["question"],
-                    "id": doc_indices[i],
+                    "id": doc_indices[idx][i],
                     # Retrieve한 Passage의 id, context를 반환합니다.
-                    "context_id": doc_indices[i],
+                    "context_id": doc_indices[idx][i],
                     "context": context
                 }
                 if "context" in example.keys() and "answers" in example.keys():
@@ -361,15 +487,20 @@ class ElasticRetrieval:
         doc_scores = []
         doc_indices = []
 
-        for query in queries:
+        res = es_msearch(self.es, self.index_name, queries, k)
+        for response in res['responses']:
             doc_score = []
             doc_index = []
-            res = es_search(self.es, self.index_name, query, k)
-            docs = res['hits']['hits']
+            if "error" in response:
+                # msearch는 실패한 query도 200으로 응답하고, 해당 response에만 error를 담아 보냅니다.
+                error = response["error"]
+                error_type = error.get("type") if isinstance(error, dict) else error
+                raise TransportError(response.get("status", "N/A"), error_type, error)
+            docs = response['hits']['hits']
 
             for hit in docs:
                 doc_score.append(hit['_score'])
-                doc_indices.append(hit['_id'])
+                doc_index.append(hit['_id'])
 
             doc_scores.append(doc_score)
             doc_indices.append(doc_index)